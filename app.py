@@ -5,9 +5,10 @@ from dotenv import load_dotenv
 import chess
 import gradio as gr
 from gradio_chessboard import Chessboard
-from langchain_core.messages import HumanMessage
-from utils.helpers import call_agent, create_agent
-from utils.tools import create_base_tools, create_mcp_tools
+from langchain_core.messages import HumanMessage, SystemMessage
+from utils.board import CachedBoard
+from utils.helpers import ChatHistory, call_agent, create_agent
+from utils.tools import MCPConnectionManager, create_base_tools
 
 # Load .env at import time so defaults pick up API keys
 load_dotenv()
@@ -40,12 +41,64 @@ MODEL_DEFAULTS = {
     },
 }
 
+# Static autoplay instructions per side. Kept out of the per-turn prompt so the
+# repeated prefix is identical every move and provider prompt caching applies.
+_SYSTEM_PROMPTS = {
+    side: (
+        "<no_think>\n"
+        f"You are playing chess as {side}. When given a position, it is strictly your turn.\n"
+        "Rules you MUST follow:\n"
+        "- Only make a legal move for your side.\n"
+        "- Output your move by CALLING the make_move tool with a UCI move in format 'from_square+to_square' (4-5 characters).\n"
+        "- UCI examples: e2e4 (pawn), g1f3 (knight), e1g1 (castling), e7e8q (pawn promotion to queen).\n"
+        "- Do NOT use algebraic notation like Nf3, Bb4, O-O, Bxe3. Use UCI format only.\n"
+        "- Do NOT attempt to move the opponent's pieces.\n"
+        "- You may use get_fen to verify the turn and position.\n"
+        "- make_move returns the new FEN and the game status. If status=ongoing, do NOT call get_status. If it indicates checkmate/stalemate/draw, announce the result clearly (e.g., 'Checkmate, Black wins') and explain briefly.\n"
+        "- Ignore any suggested moves that are illegal or belong to the opponent.\n"
+    )
+    for side in ("white", "black")
+}
+
+
+def _system_message(side: str, provider: str) -> SystemMessage:
+    """Build the autoplay system message, marked cacheable for Anthropic."""
+    if provider.lower() == "anthropic":
+        return SystemMessage(
+            content=[
+                {
+                    "type": "text",
+                    "text": _SYSTEM_PROMPTS[side],
+                    "cache_control": {"type": "ephemeral"},
+                }
+            ]
+        )
+    return SystemMessage(content=_SYSTEM_PROMPTS[side])
+
 
 async def main():
-    board = chess.Board()
+    # Caches its FEN, which is read on every streamed update
+    board = CachedBoard()
+    # LangChain-side chat histories, one per Gradio session, each extended
+    # incrementally alongside that session's chat
+    histories: dict[str, ChatHistory] = {}
+
+    def _history_for(request: gr.Request) -> ChatHistory:
+        if request.session_hash not in histories:
+            histories[request.session_hash] = ChatHistory()
+        return histories[request.session_hash]
+
+    def _drop_history(request: gr.Request):
+        histories.pop(request.session_hash, None)
 
     base_tools = create_base_tools(board)
-    mcp_tools = await create_mcp_tools(
+    # Side-restricted tools are built once and reused for every autoplay move
+    side_tools = {
+        "white": create_base_tools(board, allowed_side="white"),
+        "black": create_base_tools(board, allowed_side="black"),
+    }
+    # The MCP session is opened lazily on Gradio's event loop, where the tools run
+    mcp = MCPConnectionManager(
         url="https://agents-mcp-hackathon-chess-mcp-server.hf.space/gradio_api/mcp/sse",
         transport="sse",
     )
@@ -60,25 +113,20 @@ async def main():
         black_model_name,
         black_provider,
         black_api_key,
+        request: gr.Request,
     ):
         """Entrypoint for the chat interaction."""
+        history = _history_for(request)
         board.set_fen(fen)
         messages.append(gr.ChatMessage(role="user", content=prompt))
         yield messages, board.fen()
 
         side = 'white' if board.turn == chess.WHITE else 'black'
-        real_prompt = HumanMessage(
-            content=f"{prompt}\nCurrent board state: {board.fen()}"
-        )
         # Route chat to the side to move
         if side == 'white' and white_provider != "Human":
-            agent = create_agent(
-                white_model_name, white_provider, white_api_key, base_tools + mcp_tools
-            )
+            model_name, provider, api_key = white_model_name, white_provider, white_api_key
         elif side == 'black' and black_provider != "Human":
-            agent = create_agent(
-                black_model_name, black_provider, black_api_key, base_tools + mcp_tools
-            )
+            model_name, provider, api_key = black_model_name, black_provider, black_api_key
         else:
             # No AI to respond on this side
             messages.append(
@@ -89,10 +137,22 @@ async def main():
             )
             yield messages, board.fen()
             return
-        async for messages in call_agent(agent, messages, real_prompt):
+        try:
+            mcp_tools = await mcp.get_tools()
+        except Exception as e:
+            print(f"[chat_entrypoint][ERROR] {e}")
+            messages.append(gr.ChatMessage(role="assistant", content=f"Error: {e}"))
+            yield messages, board.fen()
+            return
+        real_prompt = HumanMessage(
+            content=f"{prompt}\nCurrent board state: {board.fen()}"
+        )
+        agent = create_agent(model_name, provider, api_key, base_tools + mcp_tools)
+        async for messages in call_agent(agent, messages, real_prompt, history, provider):
             yield messages, board.fen()
 
     async def _autoplay_until_human_or_gameover(messages,
+                                                history: ChatHistory,
                                                 white_model_name,
                                                 white_provider,
                                                 white_api_key,
@@ -101,43 +161,71 @@ async def main():
                                                 black_api_key,
                                                 max_moves: int | None = None):
         """Play consecutive AI turns until it's a human's turn or the game ends."""
-        moves = 0
-        while not board.is_game_over():
-            if max_moves is not None and moves >= max_moves:
-                break
-            side = 'white' if board.turn == chess.WHITE else 'black'
-            # Stop if human to move
-            if (side == 'white' and white_provider == "Human") or (
+
+        def _is_human(side: str) -> bool:
+            return (side == 'white' and white_provider == "Human") or (
                 side == 'black' and black_provider == "Human"
-            ):
-                break
-            # Build prompt and tools for this side
-            real_prompt = HumanMessage(
-                content=(
-                    f"""
-
-<no_think>
-You are playing chess as {side}. It is strictly your turn. """
-                    f"Board FEN: {board.fen()}.\n"
-                    "Rules you MUST follow:\n"
-                    "- Only make a legal move for your side.\n"
-                    "- Output your move by CALLING the make_move tool with a UCI move in format 'from_square+to_square' (4-5 characters).\n"
-                    "- UCI examples: e2e4 (pawn), g1f3 (knight), e1g1 (castling), e7e8q (pawn promotion to queen).\n"
-                    "- Do NOT use algebraic notation like Nf3, Bb4, O-O, Bxe3. Use UCI format only.\n"
-                    "- Do NOT attempt to move the opponent's pieces.\n"
-                    "- You may use get_fen to verify the turn and position.\n"
-                    "- After making your move, CALL get_status and if the status indicates checkmate/stalemate/draw, announce the result clearly (e.g., 'Checkmate, Black wins') and explain briefly.\n"
-                    "- Ignore any suggested moves that are illegal or belong to the opponent.\n"
-                )
             )
-            side_restricted_tools = create_base_tools(board, allowed_side=side)
+
+        async def _prepare_turn(side: str):
+            """Build the prompt and agent for `side` against the current position."""
+            fen = board.fen()
+            real_prompt = HumanMessage(content=f"Board FEN: {fen}. Your move.")
+            # Prebuilt tool objects; only the list is assembled, so agent cache keys stay stable
+            try:
+                side_restricted_tools = side_tools[side] + await mcp.get_tools()
+            except Exception as e:
+                # The MCP tools are optional for autoplay; keep playing with the local ones
+                print(f"[autoplay] MCP tools unavailable, using local tools only: {e}")
+                side_restricted_tools = side_tools[side]
             if side == 'white':
+                provider = white_provider
                 agent = create_agent(white_model_name, white_provider, white_api_key, side_restricted_tools)
             else:
+                provider = black_provider
                 agent = create_agent(black_model_name, black_provider, black_api_key, side_restricted_tools)
-            async for messages in call_agent(agent, messages, real_prompt):
-                yield messages, board.fen()
-            moves += 1
+            return fen, provider, _system_message(side, provider), real_prompt, agent
+
+        moves = 0
+        # Next side's turn, prepared while the current side is still streaming
+        next_turn: asyncio.Task | None = None
+        try:
+            while not board.is_game_over():
+                if max_moves is not None and moves >= max_moves:
+                    break
+                side = 'white' if board.turn == chess.WHITE else 'black'
+                # Stop if human to move
+                if _is_human(side):
+                    break
+                try:
+                    turn = await next_turn if next_turn is not None else None
+                    next_turn = None
+                    # Rebuild if nothing was prepared or the position changed since
+                    if turn is None or turn[0] != board.fen():
+                        turn = await _prepare_turn(side)
+                except Exception as e:
+                    # e.g. an unsupported provider; report it like an agent error
+                    print(f"[autoplay][ERROR] {e}")
+                    messages.append(gr.ChatMessage(role="assistant", content=f"Error: {e}"))
+                    break
+                _, provider, system, real_prompt, agent = turn
+                turn_color = board.turn
+                async for messages in call_agent(
+                    agent, messages, real_prompt, history, provider, system
+                ):
+                    if next_turn is None and board.turn != turn_color:
+                        # The move has been pushed; overlap the next side's setup
+                        # with the rest of this side's stream
+                        next_side = 'white' if board.turn == chess.WHITE else 'black'
+                        if not _is_human(next_side):
+                            next_turn = asyncio.create_task(_prepare_turn(next_side))
+                    yield messages, board.fen()
+                moves += 1
+        finally:
+            # Also runs when Gradio closes the generator mid-stream (reset, disconnect)
+            if next_turn is not None and not next_turn.cancel() and not next_turn.cancelled():
+                # Already finished: retrieve any error so it isn't reported as never retrieved
+                next_turn.exception()
         # Final state
         yield messages, board.fen()
 
@@ -150,11 +238,13 @@ You are playing chess as {side}. It is strictly your turn. """
         black_model_name,
         black_provider,
         black_api_key,
+        request: gr.Request,
     ):
         """After a human move, autoplay any AI turns automatically."""
         board.set_fen(fen)
         async for messages, fen in _autoplay_until_human_or_gameover(
             messages,
+            _history_for(request),
             white_model_name,
             white_provider,
             white_api_key,
@@ -172,6 +262,7 @@ You are playing chess as {side}. It is strictly your turn. """
         black_model_name,
         black_provider,
         black_api_key,
+        request: gr.Request,
         max_moves=200,
     ):
         """Reset the board and auto-play if sides are AI until it's a human's turn or game over."""
@@ -182,6 +273,7 @@ You are playing chess as {side}. It is strictly your turn. """
         # Reuse the autoplay helper for consistent behavior
         async for messages, fen in _autoplay_until_human_or_gameover(
             messages,
+            _history_for(request),
             white_model_name,
             white_provider,
             white_api_key,
@@ -341,6 +433,8 @@ You are playing chess as {side}. It is strictly your turn. """
                     outputs=[chatbot, board_component],
                 )
 
+        chessagent.unload(_drop_history)
+
         chessagent.launch()
 
 
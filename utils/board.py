@@ -0,0 +1,112 @@
+import functools
+
+import chess
+
+# Marks the outcome cache as empty, since None is a valid outcome
+_UNSET = object()
+
+# Board methods that change the position; each one drops the cached values
+_MUTATORS = (
+    "push",
+    "pop",
+    "reset",
+    "reset_board",
+    "clear",
+    "clear_board",
+    "clear_stack",
+    "set_fen",
+    "set_epd",
+    "set_board_fen",
+    "set_piece_map",
+    "set_piece_at",
+    "remove_piece_at",
+    "set_castling_fen",
+    "set_chess960_pos",
+    "apply_transform",
+    "apply_mirror",
+)
+
+# Board methods that pop and re-push moves internally but leave the position as
+# they found it; the cached values survive them
+_PRESERVING = (
+    "is_repetition",
+    "can_claim_threefold_repetition",
+    "can_claim_fifty_moves",
+    "can_claim_draw",
+)
+
+
+class CachedBoard(chess.Board):
+    """A chess board that memoizes its FEN and outcome until the position changes.
+
+    The app reads the FEN on every streamed chat update and checks for game over
+    before every autoplay turn, while the position only changes when a move is
+    made or the board is set or reset. Since ``is_game_over()`` goes through
+    ``outcome()``, the outcome computed by ``make_move`` is reused by the loop.
+
+    The caches are only dropped by the position-changing methods. Do not assign
+    state attributes directly (``turn``, ``castling_rights``, ``ep_square``,
+    ``halfmove_clock``, ``fullmove_number``, ``chess960`` or the piece bitboards);
+    that leaves a stale FEN and outcome. Use ``set_fen`` and friends instead.
+    """
+
+    _cached_fen: str | None = None
+    _cached_outcome: chess.Outcome | None | object = _UNSET
+
+    def _invalidate(self) -> None:
+        self._cached_fen = None
+        self._cached_outcome = _UNSET
+
+    def fen(self, *, shredder: bool = False, en_passant: str = "legal", promoted: bool | None = None) -> str:
+        if shredder or en_passant != "legal" or promoted is not None:
+            return super().fen(shredder=shredder, en_passant=en_passant, promoted=promoted)
+        if self._cached_fen is None:
+            self._cached_fen = super().fen()
+        return self._cached_fen
+
+    def is_insufficient_material(self) -> bool:
+        # Any pawn, rook or queen on the board is mating material for its side, which
+        # settles it for the opening and middlegame without classifying each side
+        if self.pawns | self.rooks | self.queens:
+            return False
+        return super().is_insufficient_material()
+
+    def outcome(self, *, claim_draw: bool = False) -> chess.Outcome | None:
+        if claim_draw:
+            return super().outcome(claim_draw=True)
+        if self._cached_outcome is _UNSET:
+            self._cached_outcome = super().outcome()
+        return self._cached_outcome
+
+
+def _invalidating(name: str):
+    base = getattr(chess.Board, name)
+
+    @functools.wraps(base)
+    def method(self, *args, **kwargs):
+        try:
+            return base(self, *args, **kwargs)
+        finally:
+            self._invalidate()
+
+    return method
+
+
+def _preserving(name: str):
+    base = getattr(chess.Board, name)
+
+    @functools.wraps(base)
+    def method(self, *args, **kwargs):
+        fen, outcome = self._cached_fen, self._cached_outcome
+        try:
+            return base(self, *args, **kwargs)
+        finally:
+            self._cached_fen, self._cached_outcome = fen, outcome
+
+    return method
+
+
+for _name in _MUTATORS:
+    setattr(CachedBoard, _name, _invalidating(_name))
+for _name in _PRESERVING:
+    setattr(CachedBoard, _name, _preserving(_name))
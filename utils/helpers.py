@@ -1,10 +1,25 @@
 from __future__ import annotations
 
-from typing import TYPE_CHECKING, AsyncIterator, Any
+import asyncio
+import functools
+import inspect
+import os
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, AsyncIterator, Any, Callable
 
 import gradio as gr
+import httpx
 from langchain.chat_models import init_chat_model
-from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from langchain_core.messages import (
+    AIMessage,
+    AIMessageChunk,
+    BaseMessage,
+    HumanMessage,
+    SystemMessage,
+    trim_messages,
+)
+from langchain_core.messages.utils import count_tokens_approximately
 from langgraph.prebuilt import create_react_agent
 
 if TYPE_CHECKING:
@@ -16,129 +31,302 @@ except Exception:
 
 MESSAGE_TYPE = BaseMessage | gr.ChatMessage | dict[str, str]
 
+# Verbose per-chunk logging in call_agent; off by default since it runs for every streamed chunk
+DEBUG = os.getenv("DEBUG", "").lower() in ("1", "true", "yes")
+
+# Process-wide pooled client so provider calls reuse keep-alive connections
+# instead of paying a fresh TCP/TLS handshake per agent.
+_HTTP_CLIENT = httpx.AsyncClient(
+    limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+    timeout=httpx.Timeout(600.0, connect=5.0),  # match the provider SDK defaults
+)
+
+# Minimum seconds between chat updates while agent text streams in
+_STREAM_FLUSH_INTERVAL = 0.08
+
+# Caps on in-flight agent streams per provider, so concurrent games or sides
+# don't trip provider rate limits (OpenAI 429s, Anthropic concurrency limits)
+_SEMAPHORES = {
+    "anthropic": asyncio.Semaphore(4),
+    "mistral": asyncio.Semaphore(4),
+    "openai": asyncio.Semaphore(8),
+    "gemini": asyncio.Semaphore(4),
+    "ollama": asyncio.Semaphore(int(os.getenv("OLLAMA_NUM_PARALLEL", "2"))),
+}
+
+# Compiled agents keyed by (provider, model, api key, tool ids); reusing them keeps
+# the chat model's HTTP client alive across turns instead of rebuilding per move.
+# Least recently used entries are evicted, so model names and keys typed into the
+# UI, or tools replaced by an MCP reconnect, don't pile up.
+_AGENT_CACHE: OrderedDict[tuple, CompiledGraph] = OrderedDict()
+_AGENT_CACHE_SIZE = 16
+
+
+class ChatHistory:
+    """LangChain view of the chat, extended incrementally across turns.
+
+    Only chat messages added since the last turn are converted, and the agent's own
+    messages (tool calls included) are recorded as they stream instead of being
+    re-derived from the Gradio chat on every call.
+
+    Args:
+        max_tokens (int): Approximate token budget of history sent with each turn.
+    """
+
+    def __init__(self, max_tokens: int = 4000):
+        self.messages: list[BaseMessage] = []
+        self.max_tokens = max_tokens
+        self._synced = 0
+        # (role, content) of the last synced chat message, to spot a replaced chat
+        self._last: tuple | None = None
+
+    def sync(self, messages: list[MESSAGE_TYPE]) -> None:
+        """Convert chat messages added since the last sync.
+
+        A trailing user message is dropped since the caller sends its own prompt for it.
+        """
+        if self._synced and (
+            len(messages) < self._synced
+            or _message_key(messages[self._synced - 1]) != self._last
+        ):
+            # The chat was cleared or replaced; rebuild from it
+            self.messages = []
+            self._synced = 0
+        new = [_convert_to_langchain_message(msg) for msg in messages[self._synced:]]
+        if new and isinstance(new[-1], HumanMessage):
+            new.pop()
+        self.messages.extend(new)
+        self.mark_synced(messages)
+
+    def mark_synced(self, messages: list[MESSAGE_TYPE]) -> None:
+        """Mark chat messages rendered from recorded agent output as already converted."""
+        self._synced = len(messages)
+        self._last = _message_key(messages[-1]) if messages else None
+
+    def trim(self) -> list[BaseMessage]:
+        """Drop the oldest messages beyond the token budget and return the rest."""
+        self.messages = trim_messages(
+            self.messages,
+            max_tokens=self.max_tokens,
+            strategy="last",
+            token_counter=count_tokens_approximately,
+            start_on="human",
+        )
+        return self.messages
+
 
 def create_agent(
     model_name: str, provider: str, api_key: str, tools: list
 ):
-    """Create a React agent with the specified model."""
+    """Create a React agent with the specified model, reusing a cached one if possible."""
+    key = (provider.lower(), model_name, api_key, tuple(id(t) for t in tools))
+    if key in _AGENT_CACHE:
+        _AGENT_CACHE.move_to_end(key)
+        return _AGENT_CACHE[key]
     print(f"[create_agent] provider={provider} model={model_name} api_key_set={bool(api_key)}")
     model = _create_model(model_name, provider, api_key)
     # Ensure Ollama runs without reasoning/thinking for faster inference
-    if provider == "Ollama":
+    if provider.lower() == "ollama":
         try:
             model = model.bind(think=False)
             print("[create_agent] Bound think=False for Ollama model")
         except Exception as _:
             # Binding is best-effort; model_kwargs in _create_model also sets think=False
             print("[create_agent] Warning: couldn't bind think=False; relying on model_kwargs")
-    return create_react_agent(
+    agent = create_react_agent(
         model,
         tools=tools,
     )
+    _AGENT_CACHE[key] = agent
+    if len(_AGENT_CACHE) > _AGENT_CACHE_SIZE:
+        _AGENT_CACHE.popitem(last=False)
+    return agent
 
 
 async def call_agent(
-    agent, messages: list[MESSAGE_TYPE], prompt: HumanMessage
+    agent,
+    messages: list[MESSAGE_TYPE],
+    prompt: HumanMessage,
+    history: ChatHistory,
+    provider: str,
+    system: SystemMessage | None = None,
 ) -> AsyncIterator[list[MESSAGE_TYPE]]:
-    print(f"[call_agent] prompt={prompt.content}")
-    try:
-        async for chunk in agent.astream(
-            {
-                "messages": [_convert_to_langchain_message(msg) for msg in messages[:-1]]
-                + [prompt]
-            }
-        ):
-            print(f"[call_agent] chunk keys={list(chunk.keys())}")
-            if "tools" in chunk:
-                for step in chunk["tools"]["messages"]:
-                    print(f"[call_agent] tool step name={getattr(step,'name',None)} content={getattr(step,'content',None)}")
-                    messages.append(
+    if DEBUG:
+        print(f"[call_agent] prompt={prompt.content}")
+    history.sync(messages)
+    # Recorded into history only once the agent finishes, so a failed turn never
+    # leaves a dangling tool call behind
+    turn: list[BaseMessage] = [prompt]
+    # Assistant message currently receiving token deltas, finalized when its step ends.
+    # Its text is accumulated locally and assigned, since Gradio may rewrite the
+    # content it renders
+    streaming: gr.ChatMessage | None = None
+    streamed_text = ""
+    last_flush = 0.0
+    # The system message is sent ahead of the history but never stored in it
+    prefix = [system] if system is not None else []
+    # Hold the provider's slot for the whole stream to cap concurrent requests
+    async with _SEMAPHORES[provider.lower()]:
+        try:
+            async for mode, chunk in agent.astream(
+                {"messages": prefix + history.trim() + turn}, stream_mode=["messages", "updates"]
+            ):
+                if mode == "messages":
+                    token, metadata = chunk
+                    if not isinstance(token, AIMessageChunk) or metadata.get("langgraph_node") != "agent":
+                        continue
+                    delta = _get_text_delta(token.content)
+                    if not delta:
+                        continue
+                    if streaming is None:
+                        streaming = gr.ChatMessage(role="assistant", content="")
+                        streamed_text = ""
+                        messages.append(streaming)
+                    streamed_text += delta
+                    streaming.content = streamed_text
+                    # Every yield re-renders the whole chat, so coalesce deltas
+                    now = time.monotonic()
+                    if "\n" in delta or now - last_flush >= _STREAM_FLUSH_INTERVAL:
+                        last_flush = now
+                        yield messages
+                    continue
+                if DEBUG:
+                    print(f"[call_agent] chunk keys={list(chunk.keys())}")
+                if "tools" in chunk:
+                    steps = chunk["tools"]["messages"]
+                    turn.extend(steps)
+                    if DEBUG:
+                        for step in steps:
+                            print(f"[call_agent] tool step name={getattr(step,'name',None)} content={getattr(step,'content',None)}")
+                    # Steps within one chunk are a single agent action; render them with one yield
+                    messages.extend(
                         gr.ChatMessage(
                             role="assistant",
                             content=step.content,
                             metadata={"title": f"🛠️ Used tool {step.name}"},
                         )
+                        for step in steps
                     )
                     yield messages
-            if "agent" in chunk:
-                content = _get_chunk_message_content(chunk)
-                print(f"[call_agent] agent message={content}")
-                messages.append(
-                    gr.ChatMessage(
-                        role="assistant",
-                        content=content,
+                if "agent" in chunk:
+                    turn.extend(chunk["agent"]["messages"])
+                    if streaming is not None:
+                        # Already rendered from its deltas; flush what's pending and close it off
+                        if DEBUG:
+                            print(f"[call_agent] agent message={streamed_text}")
+                        streaming = None
+                        yield messages
+                        continue
+                    # The provider didn't stream any text (e.g. a bare tool call)
+                    content = _get_chunk_message_content(chunk)
+                    if DEBUG:
+                        print(f"[call_agent] agent message={content}")
+                    messages.append(
+                        gr.ChatMessage(
+                            role="assistant",
+                            content=content,
+                        )
                     )
-                )
-                yield messages
-    except Exception as e:
-        print(f"[call_agent][ERROR] {e}")
-        messages.append(gr.ChatMessage(role="assistant", content=f"Error: {e}"))
-        yield messages
+                    yield messages
+        except Exception as e:
+            print(f"[call_agent][ERROR] {e}")
+            messages.append(gr.ChatMessage(role="assistant", content=f"Error: {e}"))
+            yield messages
+        else:
+            history.messages.extend(turn)
+        finally:
+            history.mark_synced(messages)
+
+
+def _create_ollama_model(model_name: str, api_key: str) -> BaseChatModel:
+    print(
+        f"[_create_model] Using Ollama at http://localhost:11434 model={model_name} (think=False)"
+    )
+    # keep_alive keeps the model resident between moves; the cached agent keeps
+    # the underlying ollama client (and its connection pool) alive as well
+    kwargs = {}
+    # Ollama defaults to the physical core count; only override when asked to
+    if os.getenv("OLLAMA_NUM_THREAD"):
+        kwargs["num_thread"] = int(os.environ["OLLAMA_NUM_THREAD"])
+    return init_chat_model(
+        "ollama:" + model_name,
+        base_url="http://localhost:11434",
+        keep_alive="30m",
+        **kwargs,
+    )
+
+
+# Chat model constructors keyed by lowercased provider name
+_PROVIDERS: dict[str, Callable[[str, str], BaseChatModel]] = {
+    "anthropic": lambda m, k: init_chat_model("anthropic:" + m, anthropic_api_key=k),
+    "mistral": lambda m, k: init_chat_model("mistralai:" + m, mistral_api_key=k),
+    "openai": lambda m, k: init_chat_model(
+        "openai:" + m, openai_api_key=k, http_async_client=_HTTP_CLIENT
+    ),
+    # Uses Google Generative AI via LangChain
+    "gemini": lambda m, k: init_chat_model("google_genai:" + m, api_key=k),
+    "ollama": _create_ollama_model,
+}
 
 
 def _create_model(model_name: str, provider: str, api_key: str) -> BaseChatModel:
     """Get the chat model based on the provider and model name."""
-    if provider == "Anthropic":
-        return init_chat_model(
-            "anthropic:" + model_name,
-            anthropic_api_key=api_key,
-        )
-    elif provider == "Mistral":
-        return init_chat_model(
-            "mistralai:" + model_name,
-            mistral_api_key=api_key,
-        )
-    elif provider == "OpenAI":
-        return init_chat_model(
-            "openai:" + model_name,
-            openai_api_key=api_key,
-        )
-    elif provider == "Gemini":
-        # Uses Google Generative AI via LangChain
-        return init_chat_model(
-            "google_genai:" + model_name,
-            api_key=api_key,
-        )
-    elif provider == "Ollama":
-        print(
-            f"[_create_model] Using Ollama at http://localhost:11434 model={model_name} (think=False)"
-        )
-        # Pass think=False to disable reasoning traces for models that support it
+    try:
+        factory = _PROVIDERS[provider.lower()]
+    except KeyError:
+        raise ValueError(f"Unsupported model provider: {provider}") from None
+    return factory(model_name, api_key)
 
-        return init_chat_model(
-            "ollama:" + model_name,
-            base_url="http://localhost:11434",
-        )
-    else:
-        raise ValueError(f"Unsupported model provider: {provider}")
 
+@functools.singledispatch
+def _convert_to_langchain_message(message: MESSAGE_TYPE) -> BaseMessage:
+    raise ValueError(f"Unsupported message type: {type(message)}")
 
-def _is_ai_message(message: MESSAGE_TYPE) -> bool:
-    if isinstance(message, AIMessage):
-        return True
-    if isinstance(message, gr.ChatMessage):
-        return message.role == "assistant"
-    if isinstance(message, dict):
-        return message.get("role") == "assistant"
-    return False
 
+@_convert_to_langchain_message.register(BaseMessage)
+def _(message: BaseMessage) -> BaseMessage:
+    return message
 
-def _convert_to_langchain_message(message: MESSAGE_TYPE) -> BaseMessage:
-    if isinstance(message, BaseMessage):
-        return message
-    if isinstance(message, gr.ChatMessage):
-        return (
-            AIMessage(content=message.content)
-            if _is_ai_message(message)
-            else HumanMessage(content=message.content)
-        )
+
+@_convert_to_langchain_message.register(gr.ChatMessage)
+def _(message: gr.ChatMessage) -> BaseMessage:
+    if message.role == "assistant":
+        return AIMessage(content=message.content)
+    return HumanMessage(content=message.content)
+
+
+@_convert_to_langchain_message.register(dict)
+def _(message: dict) -> BaseMessage:
+    if message.get("role") == "assistant":
+        return AIMessage(content=message.get("content", ""))
+    return HumanMessage(content=message.get("content", ""))
+
+
+def _message_key(message: MESSAGE_TYPE) -> tuple:
     if isinstance(message, dict):
-        return (
-            AIMessage(content=message.get("content", ""))
-            if _is_ai_message(message)
-            else HumanMessage(content=message.get("content", ""))
-        )
-    raise ValueError(f"Unsupported message type: {type(message)}")
+        # Chat handed back by Gradio, whose text is already cleaned
+        return (message.get("role"), message.get("content"))
+    if isinstance(message, gr.ChatMessage):
+        role, content = message.role, message.content
+    else:
+        role, content = message.type, message.content
+    # Gradio's Chatbot cleandocs message text before handing the chat back, so
+    # compare our own messages in that form (cleandoc isn't idempotent, hence
+    # only here)
+    if isinstance(content, str):
+        content = inspect.cleandoc(content)
+    return (role, content)
+
+
+def _get_text_delta(content: str | list) -> str:
+    if isinstance(content, str):
+        return content
+    # Content blocks (e.g. Anthropic); only text blocks are rendered
+    return "".join(
+        block.get("text", "")
+        for block in content
+        if isinstance(block, dict) and block.get("type") == "text"
+    )
 
 
 def _get_chunk_message_content(chunk: dict) -> str:
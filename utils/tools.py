@@ -1,6 +1,56 @@
+import asyncio
+import re
+from itertools import islice
+
 import chess
 from langchain_core.tools import BaseTool, tool
 from langchain_mcp_adapters.client import MultiServerMCPClient
+from langchain_mcp_adapters.tools import load_mcp_tools
+
+
+# Moves that are already in UCI form, e.g. e2e4 or e7e8q
+_UCI_RE = re.compile(r"[a-h][1-8][a-h][1-8][qrbn]?")
+
+# make_move status strings for drawn outcomes
+_DRAW_STATUS = {
+    chess.Termination.STALEMATE: "stalemate",
+    chess.Termination.INSUFFICIENT_MATERIAL: "draw:insufficient_material",
+    chess.Termination.THREEFOLD_REPETITION: "draw:threefold_repetition_claim_available",
+    chess.Termination.FIFTY_MOVES: "draw:fifty_move_rule_claim_available",
+}
+
+
+def _game_outcome(board: chess.Board) -> chess.Outcome | None:
+    """Return the game outcome, counting draws that can be claimed.
+
+    Equivalent to ``board.outcome(claim_draw=True)``, but the claim checks only
+    run once the halfmove clock makes them possible: a threefold repetition needs
+    8 reversible plies (7 plus the claiming move), and a fifty-move claim needs 99
+    plies plus one more.
+    """
+    outcome = board.outcome()
+    if outcome is not None:
+        return outcome
+    if (
+        board.halfmove_clock >= 7
+        and len(board.move_stack) >= 7
+        and board.can_claim_threefold_repetition()
+    ):
+        return chess.Outcome(chess.Termination.THREEFOLD_REPETITION, None)
+    if board.halfmove_clock >= 99 and board.can_claim_fifty_moves():
+        return chess.Outcome(chess.Termination.FIFTY_MOVES, None)
+    return None
+
+
+def _is_stalemate(board: chess.Board, outcome: chess.Outcome) -> bool:
+    """Whether the game ended in stalemate.
+
+    python-chess reports insufficient material ahead of stalemate, so a bare
+    minor-piece stalemate still needs the explicit check.
+    """
+    if outcome.termination == chess.Termination.STALEMATE:
+        return True
+    return outcome.termination == chess.Termination.INSUFFICIENT_MATERIAL and board.is_stalemate()
 
 
 def create_base_tools(board: chess.Board, allowed_side: str | None = None) -> list[BaseTool]:
@@ -60,22 +110,21 @@ def create_base_tools(board: chess.Board, allowed_side: str | None = None) -> li
                     print(f"[tool:make_move] {msg}")
                     return msg
             chess_move = chess.Move.from_uci(move)
-            if chess_move in board.legal_moves:
+            if board.is_legal(chess_move):
                 board.push(chess_move)
                 new_fen = board.fen()
-                status = "ongoing"
-                if board.is_checkmate():
-                    # After push, board.turn is the side with no legal moves; winner is the opposite
-                    winner = "white" if board.turn == chess.BLACK else "black"
+                outcome = _game_outcome(board)
+                if outcome is None:
+                    status = "ongoing"
+                elif outcome.termination == chess.Termination.CHECKMATE:
+                    winner = "white" if outcome.winner == chess.WHITE else "black"
                     status = f"checkmate:{winner}"
-                elif board.is_stalemate():
+                elif _is_stalemate(board, outcome):
                     status = "stalemate"
-                elif board.is_insufficient_material():
-                    status = "draw:insufficient_material"
-                elif board.can_claim_threefold_repetition():
-                    status = "draw:threefold_repetition_claim_available"
-                elif board.can_claim_fifty_moves():
-                    status = "draw:fifty_move_rule_claim_available"
+                else:
+                    status = _DRAW_STATUS.get(
+                        outcome.termination, f"draw:{outcome.termination.name.lower()}"
+                    )
                 print(f"[tool:make_move] ok new_fen={new_fen} status={status}")
                 return f"{new_fen} | status={status}"
             else:
@@ -91,10 +140,13 @@ def create_base_tools(board: chess.Board, allowed_side: str | None = None) -> li
     @tool
     def get_legal_moves() -> str:
         """Get all legal moves in UCI format for the current position."""
-        legal_moves = [move.uci() for move in board.legal_moves]
-        legal_moves_str = ", ".join(legal_moves[:20])  # Limit to first 20 to avoid overwhelming output
-        if len(list(board.legal_moves)) > 20:
-            legal_moves_str += f", ... and {len(list(board.legal_moves)) - 20} more"
+        # Single pass over the generator: format the first 20, only count the rest
+        legal_iter = iter(board.legal_moves)
+        first20 = list(islice(legal_iter, 20))  # Limit to first 20 to avoid overwhelming output
+        extra = sum(1 for _ in legal_iter)
+        legal_moves_str = ", ".join(move.uci() for move in first20)
+        if extra:
+            legal_moves_str += f", ... and {extra} more"
         print(f"[tool:get_legal_moves] {legal_moves_str}")
         return f"Legal moves (UCI format): {legal_moves_str}"
 
@@ -106,6 +158,9 @@ def create_base_tools(board: chess.Board, allowed_side: str | None = None) -> li
             algebraic_move (str): Move in algebraic notation (e.g., "Nf3", "Bxe3", "O-O")
         """
         print(f"[tool:convert_move_to_uci] input={algebraic_move}")
+        if _UCI_RE.fullmatch(algebraic_move):
+            # Already UCI; make_move validates legality, so skip SAN parsing
+            return f"UCI format: {algebraic_move}"
         try:
             # Try to parse as algebraic notation
             move = board.parse_san(algebraic_move)
@@ -121,13 +176,15 @@ def create_base_tools(board: chess.Board, allowed_side: str | None = None) -> li
         """Return a summary of the current game status (turn, check, checkmate, stalemate, result)."""
         turn = "white" if board.turn == chess.WHITE else "black"
         status = [f"turn={turn}"]
-        if board.is_checkmate():
+        outcome = _game_outcome(board)
+        termination = outcome.termination if outcome is not None else None
+        if termination == chess.Termination.CHECKMATE:
             status.append("checkmate")
-        if board.is_stalemate():
+        if outcome is not None and _is_stalemate(board, outcome):
             status.append("stalemate")
         if board.is_check():
             status.append("check")
-        status.append(f"result={board.result(claim_draw=True)}")
+        status.append(f"result={outcome.result() if outcome is not None else '*'}")
         summary = f"FEN={board.fen()} | " + ", ".join(status)
         print(f"[tool:get_status] {summary}")
         return summary
@@ -142,16 +199,68 @@ def create_base_tools(board: chess.Board, allowed_side: str | None = None) -> li
     ]
 
 
-async def create_mcp_tools(
-    url: str = "http://localhost:7860/gradio_api/mcp/sse", transport: str = "sse"
-) -> list[BaseTool]:
-    mcp_client = MultiServerMCPClient(
-        {
-            "chess": {
-                "url": url,
-                "transport": transport,
+class MCPConnectionManager:
+    """Hold a single MCP session open and hand out tools bound to it.
+
+    The session is owned by a background task on the event loop that first asks
+    for the tools, so every later tool call reuses the same SSE connection
+    instead of negotiating a new one.
+
+    Args:
+        url (str): The MCP server URL.
+        transport (str): The MCP transport to use (e.g. "sse").
+        server_name (str): The name to register the server under.
+    """
+
+    def __init__(
+        self,
+        url: str = "http://localhost:7860/gradio_api/mcp/sse",
+        transport: str = "sse",
+        server_name: str = "chess",
+    ):
+        self._client = MultiServerMCPClient(
+            {
+                server_name: {
+                    "url": url,
+                    "transport": transport,
+                }
             }
-        }
-    )
+        )
+        self._server_name = server_name
+        self._tools: list[BaseTool] | None = None
+        self._ready: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
 
-    return await mcp_client.get_tools()
+    async def get_tools(self) -> list[BaseTool]:
+        """Return the MCP tools, opening the shared session on first use."""
+        if self._tools is not None:
+            return self._tools
+        if self._task is None:
+            self._ready = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+        # Hold on to this attempt so every waiter sees its outcome
+        task, ready = self._task, self._ready
+        await ready.wait()
+        if self._tools is None:
+            # The session failed to open; let the next call retry, and surface the
+            # error to every waiter
+            if self._task is task:
+                self._task = None
+            await task
+            raise RuntimeError("MCP session closed before tools were loaded")
+        return self._tools
+
+    async def _run(self) -> None:
+        try:
+            async with self._client.session(self._server_name) as session:
+                self._tools = await load_mcp_tools(session)
+                print(f"[mcp] session open, loaded {len(self._tools)} tools")
+                self._ready.set()
+                # Keep the session alive for the lifetime of the app
+                await asyncio.Event().wait()
+        finally:
+            if self._tools is not None:
+                # The connection dropped after startup; reconnect on next request
+                self._tools = None
+                self._task = None
+            self._ready.set()